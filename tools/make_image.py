@@ -5,88 +5,432 @@ and combines them into an SD bootable image for Raspberry Pi 4.
 It uses `genisoimage` to create the ISO and `shutil` for file operations.
 It requires root privileges to mount the ISO file.
 '''
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import hashlib
 import os
+import re
+import secrets
 import subprocess
 import sys
 import urllib.request
 import shutil
 import tempfile
+import threading
 import time
-import random
-from passlib.hash import sha512_crypt
-
-def download_file(url, dest):
-    print(f"Downloading {url} to {dest}...")
-    if not os.path.exists(dest):
-        urllib.request.urlretrieve(url, dest)
-        print("Download complete.")
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_void_p]
+libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+MS_BIND = 0x1000
+MNT_DETACH = 0x2
+
+# Packages installed on top of the Azurelinux base image
+AZURELINUX_PACKAGES = [
+    'systemd', 'shadow-utils', 'openssh', 'iproute',
+    'sudo', 'procps-ng', 'less', 'vim', 'vim-extra',
+    'man-pages', 'man-db', 'which', 'wpa_supplicant',
+    'file', 'bash-completion', 'chrony', 'dhcpcd'
+]
+# Files written into the Azurelinux root and the tdnf options used to install
+# the packages. All of them end up in the cached rootfs, so they are part of
+# its cache key.
+ROOTFS_FSTAB = (
+    "proc /proc proc defaults 0 0\n"
+    "/dev/mmcblk0p2 / ext4 defaults,rw 0 1\n"
+    "/dev/mmcblk0p1 /boot/firmware vfat defaults,rw,nofail 0 1\n"
+)
+ROOTFS_HOSTNAME = "azurelinux\n"
+TDNF_OPTIONS = '-y --setopt=keepcache=1'
+# Bump when install_packages changes the rootfs in a way not covered by the
+# values above, to invalidate cached copies
+ROOTFS_RECIPE_VERSION = 1
+# Host directory bind mounted as the tdnf cache, so RPMs and repo metadata are
+# reused across builds
+TDNF_HOST_CACHE = '/var/cache/tdnf-hostcache'
+# Host directories bind mounted into the Azurelinux root for the chroot, as
+# (host path, path inside the root) pairs
+CHROOT_BIND_MOUNTS = [
+    ('/dev', 'dev'),
+    ('/proc', 'proc'),
+    ('/sys', 'sys'),
+    (TDNF_HOST_CACHE, 'var/cache/tdnf')
+]
+# Host directory holding the prepared Azurelinux rootfs, keyed by image digest
+# and the recipe above
+ROOTFS_CACHE_DIR = '/var/cache/azurelinux-pi'
+
+def ensure_root():
+    '''
+    Re-executes the script through sudo when it is not running as root, so the
+    rest of the script can mount, chroot and modify files without sudo.
+    :return: None
+    '''
+    if os.geteuid() != 0:
+        os.execvp('sudo', ['sudo', '-E', sys.executable] + sys.argv)
+
+def fetch_range(url, start, end, attempts=3, timeout=60):
+    '''
+    Downloads the bytes from start to end (inclusive) of url, retrying with
+    exponential backoff when a request fails or stalls.
+    :param url: URL to download.
+    :param start: Offset of the first byte.
+    :param end: Offset of the last byte.
+    :param attempts: Number of times to try before giving up.
+    :param timeout: Seconds a connection may stall before the request fails.
+    :return: The downloaded bytes.
+    '''
+    size = end - start + 1
+    request = urllib.request.Request(url, headers={'Range': f'bytes={start}-{end}'})
+    delay = 1
+    for attempt in range(attempts):
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                # A mirror that ignores Range answers 200 with the whole file,
+                # so check the status before reading anything
+                if response.status != 206:
+                    raise IOError(f"Got status {response.status} instead of 206 for bytes {start}-{end} of {url}")
+                data = response.read(size)
+            if len(data) != size:
+                raise IOError(f"Got {len(data)} of {size} bytes for bytes {start}-{end} of {url}")
+            return data
+        except OSError as error:
+            if attempt == attempts - 1:
+                raise
+            print(f"Fetching bytes {start}-{end} failed ({error}), retrying in {delay}s...")
+            time.sleep(delay)
+            delay *= 2
+
+def iter_download(url, connections=8, chunk_size=8 << 20, timeout=60):
+    '''
+    Yields the content of url in order. When the server supports range requests
+    the chunks are fetched over several parallel connections, otherwise the
+    content is read from a single connection.
+    :param url: URL to download.
+    :param connections: Number of parallel connections.
+    :param chunk_size: Size of each range request.
+    :param timeout: Seconds a connection may stall before the request fails.
+    :return: Generator of bytes.
+    '''
+    with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=timeout) as response:
+        length = int(response.headers.get('Content-Length', 0))
+        accepts_ranges = response.headers.get('Accept-Ranges') == 'bytes'
+        # Send the range requests where the redirects ended up, so each one
+        # does not repeat them
+        final_url = response.geturl()
+
+    if not accepts_ranges or not length:
+        with urllib.request.urlopen(final_url, timeout=timeout) as response:
+            while chunk := response.read(1 << 20):
+                yield chunk
+        return
+
+    # Keep a bounded window of ranges in flight and yield them in order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        pending = collections.deque()
+        for start in range(0, length, chunk_size):
+            end = min(start + chunk_size, length) - 1
+            pending.append(executor.submit(fetch_range, final_url, start, end, timeout=timeout))
+            if len(pending) >= 2 * connections:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def download_and_decompress(url, dest, cancelled=None):
+    '''
+    Streams an .xz file from url straight into xz, so decompression runs while
+    the download is still in progress and the compressed file never hits disk.
+    :param url: URL of the .xz file.
+    :param dest: Path where the decompressed file is written.
+    :param cancelled: Optional threading.Event that aborts the download when set.
+    :return: None
+    '''
+    print(f"Downloading and decompressing {url} to {dest}...")
+    partial = f"{dest}.part"
+    try:
+        with open(partial, 'wb') as out:
+            xz = subprocess.Popen(['xz', '-dc', '-T0'], stdin=subprocess.PIPE, stdout=out)
+            try:
+                for chunk in iter_download(url):
+                    if cancelled is not None and cancelled.is_set():
+                        raise RuntimeError(f"Download of {url} cancelled")
+                    xz.stdin.write(chunk)
+            finally:
+                try:
+                    xz.stdin.close()
+                except BrokenPipeError:
+                    pass
+                returncode = xz.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, xz.args)
+        os.rename(partial, dest)
+    except BaseException:
+        # Never leave a multi-GB partial image behind
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    print("Download complete.")
+
+def decompress_xz(path):
+    '''
+    Decompresses an .xz file next to itself, keeping the compressed file.
+    Multi-threaded xz is tried first, then pixz if installed, then plain xz.
+    :param path: Path to the .xz file.
+    :return: None
+    '''
+    try:
+        subprocess.run(['xz', '-dk', '-T0', path], check=True)
+        return
+    except subprocess.CalledProcessError:
+        print("Multi-threaded xz failed, retrying...")
+    # Remove any partial output left by the failed attempt
+    output = path[:-len('.xz')]
+    if os.path.exists(output):
+        os.remove(output)
+    if shutil.which('pixz'):
+        subprocess.run(['pixz', '-dk', path, output], check=True)
     else:
-        print(f"{dest} already exists, skipping download.")
+        subprocess.run(['xz', '-dk', path], check=True)
 
-def combine_images(raspbian, azurelinux):
+def fetch_raspbian_image(url, compressed_path, extracted_path, cancelled=None):
     '''
-    Uses the raspbian image as a base and combines it with the Azurelinux files,
-    keeping the raspbian kernel and firmware while replacing the root filesystem with Azurelinux.
-    Before copying, chroot into the Azurelinux root, run tdnf update and tdnf install systemd.
-    :param raspbian: Path to the Raspberry Pi SD image.
-    :param azurelinux: Path to the directory containing the extracted Azurelinux files.
+    Makes sure the uncompressed Raspberry Pi SD image exists, reusing an already
+    extracted or downloaded copy when there is one.
+    :param url: URL of the compressed Raspberry Pi SD image.
+    :param compressed_path: Path of a previously downloaded .xz image.
+    :param extracted_path: Path where the uncompressed image is expected.
+    :param cancelled: Optional threading.Event that aborts the download when set.
     :return: None
     '''
-    # Bind mount /dev, /proc, /sys for chroot environment
-    for fs in ['dev', 'proc', 'sys']:
-        target = os.path.join(azurelinux, fs)
-        os.makedirs(target, exist_ok=True)
-        subprocess.run(['sudo', 'mount', '--bind', f'/{fs}', target], check=True)
+    if os.path.exists(extracted_path):
+        print(f"{extracted_path} already exists, skipping download.")
+    elif os.path.exists(compressed_path):
+        # Reuse a previously downloaded compressed image
+        print(f"Decompressing {compressed_path}...")
+        decompress_xz(compressed_path)
+    else:
+        download_and_decompress(url, extracted_path, cancelled)
 
-    # Copy resolv.conf for network access in chroot
-    resolv_src = '/etc/resolv.conf'
-    resolv_dst = os.path.join(azurelinux, 'etc', 'resolv.conf')
-    subprocess.run(['sudo', 'cp', resolv_src, resolv_dst], check=True)
-    # Create a minimal fstab for root as rw
-    fstab_path = os.path.join(azurelinux, 'etc', 'fstab')
-    with open(fstab_path, 'w') as fstab:
-        fstab.write("proc /proc proc defaults 0 0\n/dev/mmcblk0p2 / ext4 defaults,rw 0 1\n/dev/mmcblk0p1 /boot/firmware vfat defaults,rw,nofail 0 1\n")
-    # Create a minimal hostname file
-    hostname_path = os.path.join(azurelinux, 'etc', 'hostname')
-    with open(hostname_path, 'w') as hostname_file:
-        hostname_file.write("azurelinux\n")
+def mount_points():
+    '''
+    Returns the current mount points, read from /proc/self/mountinfo. Unlike
+    os.path.ismount this also sees bind mounts from the same filesystem.
+    :return: Set of absolute mount point paths.
+    '''
+    with open('/proc/self/mountinfo') as mountinfo:
+        return {
+            re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), line.split()[4])
+            for line in mountinfo
+        }
+
+def remove_paths(paths):
+    '''
+    Removes files and directory trees with several threads deleting at once.
+    Directories are split one level down, so one large tree like usr does not
+    end up on a single thread. Refuses to touch paths that are or contain a
+    mount point, so a leftover bind mount never leads to deleting host files.
+    :param paths: Paths to remove.
+    :return: None
+    '''
+    mounts = mount_points()
+    for path in paths:
+        # Resolve the parent only, a symlink itself is removed and not followed
+        path = os.path.abspath(path)
+        real_path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        for mount in mounts:
+            if mount == real_path or mount.startswith(real_path + os.sep):
+                raise OSError(errno.EBUSY, "Refusing to remove a mount point", mount)
+
+    dirs = [path for path in paths if os.path.isdir(path) and not os.path.islink(path)]
+    work = [path for path in paths if path not in dirs]
+    for directory in dirs:
+        work.extend(os.path.join(directory, entry) for entry in os.listdir(directory))
+
+    def remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(remove, work))
+    for directory in dirs:
+        os.rmdir(directory)
+
+def remove_rootfs(azurelinux):
+    '''
+    Removes an extracted Azurelinux root, first detaching the chroot bind mounts
+    that an interrupted run may have left in it.
+    :param azurelinux: Path to the directory containing the Azurelinux files.
+    :return: None
+    '''
+    mounts = mount_points()
+    for _, relative_target in reversed(CHROOT_BIND_MOUNTS):
+        target = os.path.realpath(os.path.join(azurelinux, relative_target))
+        if target in mounts:
+            print(f"Unmounting leftover bind mount {target}...")
+            unmount(target)
+    remove_paths([azurelinux])
+
+def extract_container_image(image, extract_to):
+    '''
+    Copies the root filesystem of a container image into extract_to by mounting
+    the image directly and copying it with cp, which only clones the file
+    extents when the host filesystem supports reflinks.
+    :param image: Name of the container image.
+    :param extract_to: Directory where the files are copied.
+    :return: None
+    '''
+    if os.path.exists(extract_to):
+        remove_rootfs(extract_to)
+    os.makedirs(extract_to, exist_ok=True)
+
+    image_mount = subprocess.check_output(
+        ['podman', 'image', 'mount', image],
+        text=True
+    ).strip()
     try:
-        # Run tdnf update and install systemd inside chroot
-        subprocess.run(['sudo', 'chroot', azurelinux, 'tdnf', '-y', 'update'], check=True)
-        subprocess.run(['sudo', 'chroot', azurelinux, 'tdnf', '-y', 'install',
-                        'systemd', 'shadow-utils', 'openssh', 'iproute',
-                        'sudo', 'procps-ng', 'less', 'vim', 'vim-extra',
-                        'man-pages', 'man-db', 'which', 'wpa_supplicant',
-                        'file', 'bash-completion', 'chrony', 'dhcpcd'], check=True)
-        
-        password_salt = random.getrandbits(64).to_bytes(8, 'big').hex()
-        password_hash = sha512_crypt.using(salt=password_salt, rounds=5000).hash('azl')
-        subprocess.run(['sudo', 'chroot', azurelinux, 'usermod', '-p', password_hash, 'root'], check=True)
+        subprocess.run(
+            ['cp', '-a', '--reflink=auto', f'{image_mount}/.', f'{extract_to}/'],
+            check=True
+        )
     finally:
-        # Remove resolv.conf from chroot
-        subprocess.run(['sudo', 'rm', '-f', resolv_dst], check=True)
-        # Unmount bind mounts
-        for fs in ['dev', 'proc', 'sys']:
-            target = os.path.join(azurelinux, fs)
-            subprocess.run(['sudo', 'umount', target], check=True)
+        subprocess.run(['podman', 'image', 'umount', image], check=True)
 
+def move_merge(src, dst):
+    '''
+    Moves src to dst. When both are directories, the contents of src are merged
+    into dst instead, replacing entries that exist in both.
+    :param src: Path to move.
+    :param dst: Destination path.
+    :return: None
+    '''
+    if (os.path.isdir(src) and not os.path.islink(src)
+            and os.path.isdir(dst) and not os.path.islink(dst)):
+        for entry in os.listdir(src):
+            move_merge(os.path.join(src, entry), os.path.join(dst, entry))
+        return
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.rename(src, dst)
+
+def copy_tree_tar(src, dst):
+    '''
+    Copies the contents of src into dst through a tar pipe, keeping ownership,
+    permissions, hard links, xattrs, ACLs and sparse files.
+    :param src: Source directory.
+    :param dst: Destination directory.
+    :return: None
+    '''
+    tar_create = subprocess.Popen(
+        ['tar', '-C', src, '--one-file-system', '--sparse', '--xattrs', '--acls',
+         '-cf', '-', '.'],
+        stdout=subprocess.PIPE
+    )
+    tar_extract = subprocess.Popen(
+        ['tar', '-C', dst, '--numeric-owner', '--xattrs', '--xattrs-include=*',
+         '--acls', '-xpf', '-'],
+        stdin=tar_create.stdout
+    )
+    # Only the two tar processes should hold the pipe open
+    tar_create.stdout.close()
+    for process in (tar_extract, tar_create):
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+def bind_mount(source, target):
+    '''
+    Bind mounts source on target by calling mount(2) directly, without spawning
+    the mount binary.
+    :param source: Directory to bind.
+    :param target: Mount point.
+    :return: None
+    '''
+    if libc.mount(source.encode(), target.encode(), None, MS_BIND, None) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), target)
+
+def unmount(target):
+    '''
+    Lazily unmounts target by calling umount2(2) with MNT_DETACH, so it is
+    detached right away even if something still holds it busy.
+    :param target: Mount point.
+    :return: None
+    '''
+    if libc.umount2(target.encode(), MNT_DETACH) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), target)
+
+def umount_with_retry(target, attempts=5):
+    '''
+    Unmounts target, retrying with exponential backoff while it is busy.
+    :param target: Mount point to unmount.
+    :param attempts: Number of times to try before giving up.
+    :return: None
+    '''
+    delay = 0.5
+    for attempt in range(attempts):
+        # Force untranslated messages so the busy check works under any locale
+        result = subprocess.run(['umount', target], stderr=subprocess.PIPE, text=True,
+                                env={**os.environ, 'LC_ALL': 'C'})
+        if result.returncode == 0:
+            return
+        if 'busy' not in result.stderr or attempt == attempts - 1:
+            print(result.stderr, end='', file=sys.stderr)
+            raise subprocess.CalledProcessError(result.returncode, result.args)
+        print(f"{target} is busy, retrying in {delay}s...")
+        time.sleep(delay)
+        delay *= 2
+
+def write_rootfs(image, azurelinux):
+    '''
+    Replaces the root filesystem of the Raspberry Pi SD image with the Azurelinux
+    files, keeping the raspbian kernel modules and firmware.
+    :param image: Path to the Raspberry Pi SD image.
+    :param azurelinux: Path to the directory containing the prepared Azurelinux files.
+    :return: None
+    '''
     loop_device = subprocess.check_output(
-        ['sudo', 'losetup', '--find', '--show', '-P', raspbian],
+        ['losetup', '--find', '--show', '-P', image],
         text=True
     ).strip()
 
-    # Run dosfsck on partition 1 (boot, vfat)
-    subprocess.run(['sudo', 'dosfsck', '-a', f'{loop_device}p1'], check=True)
-    # Run fsck on partition 2 (root, ext4)
-    subprocess.run(['sudo', 'fsck.ext4', '-y', f'{loop_device}p2'], check=True)
+    # Run dosfsck on partition 1 (boot, vfat) and fsck on partition 2 (root, ext4)
+    # in parallel, they are independent devices. Detach the loop device if either
+    # fails, otherwise it keeps the image pinned after the caller removes it.
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            checks = [
+                executor.submit(subprocess.run, ['dosfsck', '-a', f'{loop_device}p1'], check=True),
+                executor.submit(subprocess.run, ['fsck.ext4', '-y', f'{loop_device}p2'], check=True)
+            ]
+            for check in checks:
+                check.result()
 
-    boot_mount = tempfile.mkdtemp(prefix="mnt_boot_")
-    root_mount = tempfile.mkdtemp(prefix="mnt_root_")
+        boot_mount = tempfile.mkdtemp(prefix="mnt_boot_")
+        root_mount = tempfile.mkdtemp(prefix="mnt_root_")
+    except BaseException:
+        subprocess.run(['losetup', '-d', loop_device])
+        raise
 
     try:
-        subprocess.run(['sudo', 'mount', f'{loop_device}p1', boot_mount], check=True)
-        subprocess.run(['sudo', 'mount', f'{loop_device}p2', root_mount], check=True)
+        # The image is written once, so trade crash consistency for throughput
+        # and flush everything with a single sync per partition before unmounting
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            mounts = [
+                executor.submit(subprocess.run, ['mount', '-o', 'noatime',
+                                                 f'{loop_device}p1', boot_mount], check=True),
+                executor.submit(subprocess.run, ['mount', '-o', 'noatime,nodiratime,barrier=0,data=writeback,commit=600',
+                                                 f'{loop_device}p2', root_mount], check=True)
+            ]
+            for mount in mounts:
+                mount.result()
 
         #modules_backup = os.path.join(root_mount, 'modules_backup')
         #modules_dir = os.path.join(root_mount, 'lib', 'modules')
@@ -94,65 +438,48 @@ def combine_images(raspbian, azurelinux):
         #    subprocess.run(['sudo', 'mkdir', '-p', modules_backup], check=True)
         #    subprocess.run(['sudo', 'mv', modules_dir, modules_backup], check=True)
 
-        # Backup important Raspbian directories before cleaning
-        backup_tar = os.path.join(root_mount, "raspbian_preserve.tar")
-        backup_tar_tmp = "/tmp/raspbian_preserve.tar"
-        dirs_to_backup = []
+        # Move important Raspbian directories aside before cleaning. They stay on
+        # the same partition, so this is a rename instead of a copy.
+        preserve_dir = os.path.join(root_mount, ".preserve")
+        dirs_to_preserve = []
         if os.path.exists(os.path.join(root_mount, "usr/lib/modules")):
-            print("Backing up /usr/lib/modules...")
-            dirs_to_backup.append("usr/lib/modules")
+            print("Preserving /usr/lib/modules...")
+            dirs_to_preserve.append("usr/lib/modules")
         else:
             print("No /usr/lib/modules found, skipping backup.")
         if os.path.exists(os.path.join(root_mount, "usr/src")):
-            print("Backing up /usr/src...")
-            dirs_to_backup.append("usr/src")
+            print("Preserving /usr/src...")
+            dirs_to_preserve.append("usr/src")
         else:
             print("No /usr/src found, skipping backup.")
 
         if os.path.exists(os.path.join(root_mount, "usr/lib/firmware")):
-            dirs_to_backup.append("usr/lib/firmware")
+            dirs_to_preserve.append("usr/lib/firmware")
         usr_lib = os.path.join(root_mount, "usr/lib")
         for entry in os.listdir(usr_lib):
             if entry.startswith("rasp"):
-                dirs_to_backup.append(f"usr/lib/{entry}")
-        if dirs_to_backup:
-            subprocess.run(
-                ["sudo", "tar", "cf", backup_tar] + dirs_to_backup,
-                cwd=root_mount,
-                check=True
-            )
-            # Move the tar to /tmp/ so it survives the cleanup
-            subprocess.run(['sudo', 'mv', backup_tar, backup_tar_tmp], check=True)
-
-        # Clean root partition except for /boot, then copy Azurelinux files
-        for entry in os.listdir(root_mount):
-            if entry == 'boot':
-                continue
-            entry_path = os.path.join(root_mount, entry)
-            if os.path.isdir(entry_path):
-                subprocess.run(['sudo', 'rm', '-rf', entry_path], check=True)
-            else:
-                subprocess.run(['sudo', 'rm', '-f', entry_path], check=True)
-
-        # Copy Azurelinux files into root partition
-        for entry in os.listdir(azurelinux):
-            src = os.path.join(azurelinux, entry)
-            dst = os.path.join(root_mount, entry)
-            if os.path.isdir(src):
-                subprocess.run(['sudo', 'cp', '-a', src, dst], check=True)
-            else:
-                subprocess.run(['sudo', 'cp', src, dst], check=True)
-
-        # Restore the preserved directories from the tar archive
-        if os.path.exists(backup_tar_tmp):
-            print(f"Restoring preserved directories from {backup_tar_tmp}...")
-            subprocess.run(
-                ["sudo", "tar", "xf", backup_tar_tmp, "-C", root_mount],
-                check=True
-            )
-            subprocess.run(['sudo', 'rm', '-f', backup_tar_tmp], check=True)
+                dirs_to_preserve.append(f"usr/lib/{entry}")
+        for preserved in dirs_to_preserve:
+            move_merge(os.path.join(root_mount, preserved), os.path.join(preserve_dir, preserved))
+
+        # Clean root partition except for /boot and the preserved directories
+        remove_paths([
+            os.path.join(root_mount, entry)
+            for entry in os.listdir(root_mount)
+            if entry not in ('boot', '.preserve')
+        ])
+
+        # Copy Azurelinux files into root partition in a single pass
+        copy_tree_tar(azurelinux, root_mount)
+
+        # Move the preserved directories back into place
+        if dirs_to_preserve:
+            print("Restoring preserved directories...")
+            for preserved in dirs_to_preserve:
+                move_merge(os.path.join(preserve_dir, preserved), os.path.join(root_mount, preserved))
+            shutil.rmtree(preserve_dir)
         else:
-            print(f"No preserved directories found in {backup_tar_tmp}, skipping restoration.")
+            print("No preserved directories found, skipping restoration.")
 
         ## Ensure 'rw' is present at the end of /boot/cmdline.txt
         #cmdline_path = os.path.join(azurelinux, 'boot', 'firmware', 'cmdline.txt')
@@ -162,16 +489,183 @@ def combine_images(raspbian, azurelinux):
         print("Combined image created successfully.")
 
     finally:
-        time.sleep(5)  # Ensure all operations are complete before unmounting
-        subprocess.run(['sudo', 'umount', boot_mount], check=True)
-        subprocess.run(['sudo', 'umount', root_mount], check=True)
-        subprocess.run(['sudo', 'losetup', '-d', loop_device], check=True)
-        shutil.rmtree(boot_mount)
-        shutil.rmtree(root_mount)
+        # Run every teardown step even when one fails, so the loop device is
+        # always released, then report the first failure
+        teardown_errors = []
+        # Ensure all writes reached the image before unmounting
+        for mount_point in (boot_mount, root_mount):
+            result = subprocess.run(['sync', '-f', mount_point])
+            if result.returncode != 0:
+                teardown_errors.append(subprocess.CalledProcessError(result.returncode, result.args))
+        for mount_point in (boot_mount, root_mount):
+            try:
+                umount_with_retry(mount_point)
+            except subprocess.CalledProcessError as error:
+                teardown_errors.append(error)
+            else:
+                # rmdir, not rmtree, so a mount point that is still mounted is never emptied
+                os.rmdir(mount_point)
+        result = subprocess.run(['losetup', '-d', loop_device])
+        if result.returncode != 0:
+            teardown_errors.append(subprocess.CalledProcessError(result.returncode, result.args))
+        if teardown_errors:
+            raise teardown_errors[0]
+
+def install_packages(azurelinux):
+    '''
+    Chroots into the Azurelinux root, runs tdnf update and tdnf install systemd and
+    the rest of AZURELINUX_PACKAGES, and writes a minimal fstab and hostname.
+    :param azurelinux: Path to the directory containing the extracted Azurelinux files.
+    :return: None
+    '''
+    resolv_dst = os.path.join(azurelinux, 'etc', 'resolv.conf')
+    mounted = []
+    try:
+        # Bind mount /dev, /proc, /sys and the host tdnf cache for the chroot
+        # environment, remembering what was mounted so a failure halfway is undone
+        for source, relative_target in CHROOT_BIND_MOUNTS:
+            target = os.path.join(azurelinux, relative_target)
+            os.makedirs(source, exist_ok=True)
+            os.makedirs(target, exist_ok=True)
+            bind_mount(source, target)
+            mounted.append(target)
+
+        # Copy resolv.conf for network access in chroot
+        shutil.copy2('/etc/resolv.conf', resolv_dst)
+        # Create a minimal fstab for root as rw
+        fstab_path = os.path.join(azurelinux, 'etc', 'fstab')
+        with open(fstab_path, 'w') as fstab:
+            fstab.write(ROOTFS_FSTAB)
+        # Create a minimal hostname file
+        hostname_path = os.path.join(azurelinux, 'etc', 'hostname')
+        with open(hostname_path, 'w') as hostname_file:
+            hostname_file.write(ROOTFS_HOSTNAME)
+
+        # Run tdnf update and install systemd in a single chroot, keeping the
+        # downloaded RPMs in the host cache
+        tdnf = f'tdnf {TDNF_OPTIONS}'
+        subprocess.run(['chroot', azurelinux, 'sh', '-c',
+                        f"{tdnf} update && {tdnf} install {' '.join(AZURELINUX_PACKAGES)}"],
+                       check=True)
+    finally:
+        # Remove resolv.conf from chroot
+        if os.path.lexists(resolv_dst):
+            os.remove(resolv_dst)
+        # Unmount every bind mount even if one fails, then report the first failure
+        unmount_errors = []
+        for target in reversed(mounted):
+            try:
+                unmount(target)
+            except OSError as error:
+                unmount_errors.append(error)
+        if unmount_errors:
+            raise unmount_errors[0]
+
+def prepare_rootfs(image, extract_to):
+    '''
+    Extracts the container image into extract_to and installs the packages in it.
+    The result is cached per image digest, package list and rootfs recipe, so
+    later builds with the same inputs only unpack the cached tarball.
+    :param image: Name of the Azurelinux container image.
+    :param extract_to: Directory where the prepared root filesystem is placed.
+    :return: None
+    '''
+    image_digest = subprocess.check_output(
+        ['podman', 'image', 'inspect', '--format', '{{.Digest}}', image],
+        text=True
+    ).strip()
+    cache_key = hashlib.sha256('\n'.join([
+        image_digest,
+        ' '.join(sorted(AZURELINUX_PACKAGES)),
+        ROOTFS_FSTAB,
+        ROOTFS_HOSTNAME,
+        TDNF_OPTIONS,
+        str(ROOTFS_RECIPE_VERSION)
+    ]).encode()).hexdigest()
+    cache_path = os.path.join(ROOTFS_CACHE_DIR, f'{cache_key}.tar')
+
+    if os.path.exists(cache_path):
+        print(f"Restoring prepared Azurelinux rootfs from {cache_path}...")
+        if os.path.exists(extract_to):
+            remove_rootfs(extract_to)
+        os.makedirs(extract_to, exist_ok=True)
+        subprocess.run(
+            ['tar', '-C', extract_to, '--numeric-owner', '--xattrs', '--xattrs-include=*',
+             '--acls', '-xpf', cache_path],
+            check=True
+        )
+        return
+
+    extract_container_image(image, extract_to)
+    install_packages(extract_to)
+
+    # Store the prepared rootfs atomically, through a temporary file private to
+    # this build, and drop the tarballs for older inputs
+    print(f"Caching prepared Azurelinux rootfs in {cache_path}...")
+    os.makedirs(ROOTFS_CACHE_DIR, exist_ok=True)
+    fd, partial = tempfile.mkstemp(dir=ROOTFS_CACHE_DIR, suffix='.tar.tmp')
+    os.close(fd)
+    try:
+        subprocess.run(
+            ['tar', '-C', extract_to, '--one-file-system', '--sparse', '--xattrs', '--acls',
+             '-cf', partial, '.'],
+            check=True
+        )
+        os.rename(partial, cache_path)
+    except BaseException:
+        os.remove(partial)
+        raise
+    for entry in os.listdir(ROOTFS_CACHE_DIR):
+        if entry.endswith('.tar') and entry != os.path.basename(cache_path):
+            os.remove(os.path.join(ROOTFS_CACHE_DIR, entry))
+
+def combine_images(raspbian, azurelinux):
+    '''
+    Uses the raspbian image as a base and combines it with the Azurelinux files,
+    keeping the raspbian kernel and firmware while replacing the root filesystem with Azurelinux.
+    Before copying, sets the root password inside the Azurelinux root.
+    :param raspbian: Path to the Raspberry Pi SD image.
+    :param azurelinux: Path to the directory containing the prepared Azurelinux files.
+    :return: None
+    '''
+    password_salt = secrets.token_hex(8)
+    password_hash = subprocess.check_output(
+        ['openssl', 'passwd', '-6', '-salt', password_salt, 'azl'],
+        text=True
+    ).strip()
+    subprocess.run(['chroot', azurelinux, 'usermod', '-p', password_hash, 'root'], check=True)
+
+    # Work on a copy of the image in tmpfs when there is room for it, so the
+    # many small writes below go to memory instead of the disk. The image on
+    # disk is only replaced once the build succeeded.
+    build_image = raspbian
+    if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free > os.path.getsize(raspbian):
+        fd, build_image = tempfile.mkstemp(dir='/dev/shm', suffix='.img')
+        os.close(fd)
+        print(f"Copying {raspbian} to {build_image}...")
+        try:
+            subprocess.run(['cp', '--sparse=always', raspbian, build_image], check=True)
+        except BaseException:
+            os.remove(build_image)
+            raise
+
+    try:
+        write_rootfs(build_image, azurelinux)
+        if build_image != raspbian:
+            print(f"Copying {build_image} back to {raspbian}...")
+            try:
+                subprocess.run(['cp', '--sparse=always', build_image, raspbian], check=True)
+            except BaseException:
+                # A half written image must not be picked up by the next run
+                os.remove(raspbian)
+                raise
+    finally:
+        if build_image != raspbian:
+            os.remove(build_image)
 
 def cleanup():
     '''
-    It cleans up the azurelinux_extracted folder as root,
+    It cleans up the azurelinux_extracted folder,
     the uncompressed RaspiOS image, and compresses the final AzureLinux image.
     :return: None
     '''
@@ -185,7 +679,7 @@ def cleanup():
         print(f"Renamed {raspbian_sd_image_extracted_img} to {azurelinux_image}")
     # Remove the extracted Azurelinux directory
     if os.path.exists(extract_to):
-        subprocess.run(['sudo', 'rm', '-rf', extract_to], check=True)
+        remove_rootfs(extract_to)
         print(f"Removed {extract_to}")
     # Remove the uncompressed Raspberry Pi SD image
     if os.path.exists(raspbian_sd_image_extracted_img):
@@ -193,14 +687,15 @@ def cleanup():
         print(f"Removed {raspbian_sd_image_extracted_img}")
     # Compress the final AzureLinux image
     if os.path.exists(azurelinux_image):
-        subprocess.run(['zstd', f'-v9T', azurelinux_image], check=True)
+        subprocess.run(['zstd', '-v', '-9', '-T0', '--long=27', '--rm', azurelinux_image], check=True)
         print(f"Compressed {azurelinux_image} to {azurelinux_image}.zst")
     else:
         print(f"{azurelinux_image} does not exist, skipping compression.")
 
 
 def main():
-    subprocess.run(['sudo', 'losetup', '-D'], check=True)
+    ensure_root()
+    subprocess.run(['losetup', '-D'], check=True)
     # Docker image for Azurelinux
     azurelinux_docker_image = "mcr.microsoft.com/azurelinux/base/core:3.0"
     extract_to = "azurelinux_extracted"
@@ -208,39 +703,39 @@ def main():
     raspbian_sd_image_path = "2025-05-13-raspios-bookworm-arm64-lite.img.xz"
     raspbian_sd_image_extracted_path = "2025-05-13-raspios-bookworm-arm64-lite.img"
 
-    # Pull the Azurelinux Docker image
-    subprocess.run(['podman', 'pull', azurelinux_docker_image], check=True)
-
-    # Create a container from the image (but do not start it)
-    container_id = subprocess.check_output(
-        ['podman', 'create', azurelinux_docker_image],
-        text=True
-    ).strip()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    cancel_download = threading.Event()
+    try:
+        # Download and extract the Raspberry Pi SD image in the background
+        raspbian_future = executor.submit(
+            fetch_raspbian_image,
+            raspbian_sd_image_url,
+            raspbian_sd_image_path,
+            raspbian_sd_image_extracted_path,
+            cancel_download
+        )
 
-    # Copy files from the container to the extract_to directory
-    if os.path.exists(extract_to):
-        shutil.rmtree(extract_to)
-    os.makedirs(extract_to, exist_ok=True)
-    subprocess.run(['podman', 'cp', f'{container_id}:/', extract_to], check=True)
+        # Pull the Azurelinux Docker image
+        subprocess.run(['podman', 'pull', azurelinux_docker_image], check=True)
 
-    # Remove the container
-    subprocess.run(['podman', 'rm', container_id], check=True)
+        # Stop before the long package install if the download already failed
+        if raspbian_future.done():
+            raspbian_future.result()
 
-    # Download the Raspberry Pi SD image
-    download_file(raspbian_sd_image_url, raspbian_sd_image_path)
+        # Copy files from the image to the extract_to directory and install
+        # the packages, or reuse a cached copy of the result
+        prepare_rootfs(azurelinux_docker_image, extract_to)
 
-    # Extract the Raspberry Pi SD image
-    if not os.path.exists(raspbian_sd_image_path):
-        raise FileNotFoundError(f"Raspberry Pi SD image {raspbian_sd_image_path} does not exist.")
-    print(f"Extracting {raspbian_sd_image_path}...")
-    if not os.path.exists(raspbian_sd_image_path.replace('.xz', '')):
-        # Use xz to decompress the image
-        print("Decompressing Raspberry Pi SD image...")    
-        nproc = subprocess.check_output(['nproc'], text=True).strip()
-        subprocess.run(['xz', '-dk', '-T', nproc, raspbian_sd_image_path], check=True)
+        # Wait for the Raspberry Pi SD image
+        raspbian_future.result()
+    except BaseException:
+        # Abort the download instead of waiting for it before reporting the error
+        cancel_download.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
 
     # Mount the extracted Raspberry Pi SD image
-    raspbian_sd_image_extracted_path = raspbian_sd_image_path.replace('.xz', '')
     if not os.path.exists(raspbian_sd_image_extracted_path):
         raise FileNotFoundError(f"Extracted Raspberry Pi SD image {raspbian_sd_image_extracted_path} does not exist.")
     combine_images(raspbian_sd_image_extracted_path, extract_to)